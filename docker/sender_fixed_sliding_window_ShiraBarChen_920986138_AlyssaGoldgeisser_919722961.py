@@ -4,9 +4,18 @@ Fixed Sliding Window Protocol
 ECS 152A - Computer Networks Project 1
 """
 
+import ctypes
+import errno
+import logging
+import math
+import mmap
+import os
+import select
 import socket
+import struct
 import time
 import sys
+from array import array
 from collections import deque
 
 # Constants
@@ -15,10 +24,31 @@ SEQ_ID_SIZE = 4
 MESSAGE_SIZE = PACKET_SIZE - SEQ_ID_SIZE
 RECEIVER_IP = '127.0.0.1'
 RECEIVER_PORT = 5001
+RECEIVER_ADDR = (RECEIVER_IP, RECEIVER_PORT)
 TIMEOUT = 0.5
+TIMEOUT_NS = int(TIMEOUT * 1e9)  # also the ceiling for the adaptive RTO
+MIN_RTO_NS = 1000000  # 1 ms
 MAX_RETRIES = 50
+MAX_STALL_NS = MAX_RETRIES * TIMEOUT_NS  # give up once the window is stuck this long, 25 s
+MAX_BACKOFF_NS = 8000000000  # 8 s, cap for the backed off retransmit timer
+PER_PKT_RETRY_LIMIT = 10  # sends of one packet before timeouts skip it, except at the window start
 FILE_PATH = 'file.mp3'
 WINDOW_SIZE = 100
+DUP_ACK_THRESHOLD = 3  # duplicate ACKs before a fast retransmit
+SOCKET_BUFFER_SIZE = 8 * 1024 * 1024  # kernel may cap at wmem_max/rmem_max
+SEND_BURST = 16  # packets sent between ACK drains
+DEBUG = False  # progress/retransmit logging to stderr
+LOG_EVERY = 10  # timeouts between debug log lines
+UDP_GRO = 104  # linux/udp.h, not exported by the socket module
+ACK_BATCH = 64  # most ACK datagrams taken from one coalesced read
+ACK_SIZE = SEQ_ID_SIZE + 3  # seq id + b'ack' or b'fin', every receiver datagram
+MAX_ACK_DELAY_NS = 0  # receiver ACKs every packet, raise if it delays ACKs
+
+# Monotonic integer clock for the hot path, immune to wall clock jumps
+now = time.monotonic_ns
+
+# Lazy %-style logging, a disabled level costs one check and no formatting
+log = logging.getLogger(__name__).debug
 
 def create_packet(seq_id, data):
     # Create a packet
@@ -32,16 +62,137 @@ def parse_ack(ack_packet):
         return ack_id
     return -1
 
+def recv_acks(sock, gro_view):
+    # Read the next ACK ids. With UDP_GRO the kernel may return several
+    # equally sized ACK datagrams back to back. Until that is first seen a
+    # plain recv is used, it is cheaper than recvmsg and a merged read (at
+    # most ACK_BATCH ACKs) still fits in PACKET_SIZE, split at ACK_SIZE.
+    # After that gro_view is read with recvmsg_into and split at the cmsg
+    # segment size
+    if gro_view is None:
+        data = sock.recv(PACKET_SIZE)
+        if len(data) <= ACK_SIZE:
+            return (parse_ack(data),)
+        return [parse_ack(data[k:k + ACK_SIZE]) for k in range(0, len(data), ACK_SIZE)]
+    nbytes, ancdata, _, _ = sock.recvmsg_into((gro_view,), socket.CMSG_SPACE(4))
+    seg_size = nbytes or 1
+    for level, kind, cdata in ancdata:
+        if level == socket.IPPROTO_UDP and kind == UDP_GRO:
+            seg_size = struct.unpack('i', cdata[:4])[0]
+    return [parse_ack(gro_view[k:k + seg_size]) for k in range(0, nbytes, seg_size)]
+
+def update_rtt(srtt, rttvar, sample):
+    # Jacobson/Karels smoothed RTT and RTT variance (RFC 6298)
+    if srtt is None:
+        return sample, sample / 2
+    rttvar = 0.75 * rttvar + 0.25 * abs(srtt - sample)
+    srtt = 0.875 * srtt + 0.125 * sample
+    return srtt, rttvar
+
+# sendmmsg(2) structures, so a whole window goes out in one syscall
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+try:
+    libc = ctypes.CDLL("libc.so.6", use_errno=True)
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+except (OSError, AttributeError):
+    # Not Linux/glibc, send_batch falls back to one send per packet
+    libc = None
+
+def create_mmsg_batch(size, headers, payload):
+    # Preallocate mmsghdr/iovec arrays, two iovecs per message (seq id header,
+    # then payload) that the kernel gathers into one datagram, so packets are
+    # never assembled in userspace. No msg_name as the socket is connected
+    iovs = (iovec * (2 * size))()
+    msgs = (mmsghdr * size)()
+    for i in range(size):
+        iovs[2 * i].iov_len = SEQ_ID_SIZE
+        hdr = msgs[i].msg_hdr
+        hdr.msg_iov = ctypes.pointer(iovs[2 * i])
+        hdr.msg_iovlen = 2
+    headers_view = memoryview(headers).cast('B')
+    payload_view = memoryview(payload)
+    headers_ptr = ctypes.c_char.from_buffer(headers) if headers else None
+    payload_ptr = ctypes.c_char.from_buffer(payload) if payload else None
+    return msgs, iovs, headers_ptr, payload_ptr, headers_view, payload_view
+
+def send_batch(sock, batch, indices):
+    # Send the given packets with as few sendmmsg calls as possible, returns
+    # how many from the front of indices went out
+    msgs, iovs, headers_ptr, payload_ptr, headers_view, payload_view = batch
+    total_bytes = len(payload_view)
+    count = len(indices)
+    sent = 0
+    if libc is not None:
+        headers_base = ctypes.addressof(headers_ptr)
+        payload_base = ctypes.addressof(payload_ptr)
+        for k, i in enumerate(indices):
+            offset = i * MESSAGE_SIZE
+            iovs[2 * k].iov_base = headers_base + i * SEQ_ID_SIZE
+            iov = iovs[2 * k + 1]
+            iov.iov_base = payload_base + offset
+            iov.iov_len = min(MESSAGE_SIZE, total_bytes - offset)
+        while sent < count:
+            n = libc.sendmmsg(sock.fileno(), ctypes.byref(msgs, sent * ctypes.sizeof(mmsghdr)), count - sent, 0)
+            if n >= 0:
+                sent += n
+                continue
+            if ctypes.get_errno() != errno.EINTR:
+                break  # e.g. send buffer full, finish with send below
+    for i in indices[sent:]:
+        offset = i * MESSAGE_SIZE
+        try:
+            sock.sendmsg([headers_view[i * SEQ_ID_SIZE:(i + 1) * SEQ_ID_SIZE],
+                          payload_view[offset:offset + MESSAGE_SIZE]])
+        except BlockingIOError:
+            break  # send buffer full, the rest go out on a later call
+        except Exception as e:
+            pass  # e.g. ICMP unreachable, the packet counts as lost
+        sent += 1
+    return sent
+
 def send_file_fixed_window():
     
     # Create UDP socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
     sock.settimeout(TIMEOUT)
+
+    # Fix the peer once so sends skip the per-call address conversion
+    sock.connect(RECEIVER_ADDR)
+
+    # Let the kernel coalesce ACK bursts into one read (Linux 5.0+)
+    try:
+        sock.setsockopt(socket.IPPROTO_UDP, UDP_GRO, 1)
+    except OSError:
+        pass
+    gro_view = None  # receive buffer, allocated once a read comes back merged
     
-    # Read file data
+    # Map the file instead of reading it, sendmmsg points straight into the
+    # page cache. ACCESS_COPY because ctypes only takes writable buffers,
+    # nothing is ever written so no page is actually copied
     try:
         with open(FILE_PATH, 'rb') as f:
-            file_data = f.read()
+            if os.fstat(f.fileno()).st_size:
+                file_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            else:
+                file_data = bytearray()  # mmap refuses empty files
     except Exception as e:
         return None, None, None
     
@@ -51,126 +202,177 @@ def send_file_fixed_window():
     # Start timing for throughput
     start_time = time.time()
     
-    # Prepare all packets
-    packets = []
-    offset = 0
-    seq_id = 0
-    while offset < total_bytes:
-        chunk = file_data[offset:offset + MESSAGE_SIZE]
-        packets.append({
-            'seq_id': seq_id,
-            'data': chunk,
-            'packet': create_packet(seq_id, chunk),
-            'offset': offset,
-            'acked': False,
-            'first_send_time': None,
-            'send_count': 0
-        })
-        seq_id += len(chunk)
-        offset += len(chunk)
-    
+    # Packet i is its 4 byte seq id header followed by file_data[seq_ids[i]:],
+    # the headers are the seq ids themselves swapped to network byte order
+    seq_ids = array('i', range(0, total_bytes, MESSAGE_SIZE))
+    seq_headers = array('i', seq_ids)
+    if sys.byteorder == 'little':
+        seq_headers.byteswap()
+
+    # Per packet state, one flat array per field. A packet is acked once it
+    # falls below window_start, so acked_ns doubles as the acked flag
+    first_send_ns = array('q', [0]) * total_packets  # 0 until first sent
+    acked_ns = array('q', [0]) * total_packets
+    send_count = array('I', [0]) * total_packets
+    last_send_ns = array('q', [0]) * total_packets
+
     # Sliding window variables
     window_start = 0  # first unacked packet
     next_to_send = 0  # next packet to send
-    packet_delays = []
     total_packets_sent = 0
-    
-    # Send packets
-    while window_start < len(packets):
-        # Send new packets within window
-        window_end = min(window_start + WINDOW_SIZE, len(packets))
-        
-        while next_to_send < window_end:
-            pkt = packets[next_to_send]
-            
-            # Only send if not already acked
-            if not pkt['acked']:
-                try:
-                    sock.sendto(pkt['packet'], (RECEIVER_IP, RECEIVER_PORT))
-                    total_packets_sent += 1
-                    pkt['send_count'] += 1
-                    
-                    # Record first send time
-                    if pkt['first_send_time'] is None:
-                        pkt['first_send_time'] = time.time()
-                    
-
-                        
-                except Exception as e:
-                    pass
-            
-            next_to_send += 1
-        
+    batch = create_mmsg_batch(WINDOW_SIZE, seq_headers, file_data)
+
+    # Send packets, draining ACKs between bursts so the window keeps sliding
+    sock.setblocking(False)
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    ready = poller.poll  # timeout in ms, returns [] when it expires
+    last_ack_ns = now()  # retransmit timer start, last ACK or timeout
+    moved_ns = last_ack_ns  # last time the window moved
+    retry_count = 0
+    srtt = rttvar = None
+    rto_ns = TIMEOUT_NS  # until the first RTT sample
+    dup_count = 0
+    recover = 0  # recovery after a loss lasts until the window passes this packet
+    log_tick = 0  # timeouts since the last debug log line
+
+    while window_start < total_packets:
+        # Send the next burst of new packets within window
+        window_end = min(window_start + WINDOW_SIZE, total_packets)
+        if next_to_send < window_end:
+            to_send = range(next_to_send, min(next_to_send + SEND_BURST, window_end))
+            sent = send_batch(sock, batch, to_send)
+            total_packets_sent += sent
+            next_to_send += sent
+
+            # Only what actually went out, a full send buffer leaves the
+            # rest for the next pass
+            send_ns = now()
+            for i in to_send[:sent]:
+                send_count[i] += 1
+                last_send_ns[i] = send_ns
+
+                # Record first send time
+                if not first_send_ns[i]:
+                    first_send_ns[i] = send_ns
+
+            wait = 0  # just poll, there may be more of the window to send
+        else:
+            # Retransmit timer, doubled for every consecutive timeout
+            timer_ns = min(MAX_BACKOFF_NS, rto_ns << retry_count, moved_ns + MAX_STALL_NS - last_ack_ns)
+            wait = max(0, timer_ns - (now() - last_ack_ns)) * 1e-6
+
         # Receive ACKs
-        ack_received = False
-        retry_count = 0
-        
-        while retry_count < MAX_RETRIES:
-            try:
-                ack_packet, _ = sock.recvfrom(PACKET_SIZE)
-                ack_id = parse_ack(ack_packet)
-                ack_received = True
-                
-                # Mark all packets with seq_id < ack_id as acked
-                packets_acked = 0
-                for i in range(window_start, len(packets)):
-                    pkt = packets[i]
-                    if pkt['seq_id'] < ack_id and not pkt['acked']:
-                        pkt['acked'] = True
-                        packets_acked += 1
-                        
-                        # Calc delay for this packet
-                        if pkt['first_send_time'] is not None:
-                            delay = time.time() - pkt['first_send_time']
-                            packet_delays.append(delay)
-                
-                # Slide window forward to first unacked packet
-                while window_start < len(packets) and packets[window_start]['acked']:
-                    window_start += 1
-                
-                # Reset next_to_send
-                next_to_send = window_start
-                
-                if packets_acked > 0:
-                    break  # Got useful ACK, continue sending
-                    
-            except socket.timeout:
-                retry_count += 1
-                
-                # Timeout
-                if retry_count % 10 == 0:
-                    pass
-                
-                # Retransmit unacked packets
-                for i in range(window_start, min(window_start + WINDOW_SIZE, len(packets))):
-                    pkt = packets[i]
-                    if not pkt['acked']:
-                        try:
-                            sock.sendto(pkt['packet'], (RECEIVER_IP, RECEIVER_PORT))
-                            total_packets_sent += 1
-                            pkt['send_count'] += 1
-                        except Exception as e:
-                            pass
-        
-        if retry_count >= MAX_RETRIES:
-            sock.close()
-            return None, None, None
+        if ready(wait):
+            while True:
+                try:
+                    ack_ids = recv_acks(sock, gro_view)
+                except (BlockingIOError, ConnectionRefusedError):
+                    break  # drained, or ICMP unreachable before the receiver is up
+                if gro_view is None and len(ack_ids) > 1:
+                    gro_view = memoryview(bytearray(ACK_BATCH * ACK_SIZE))
+                for ack_id in ack_ids:
+                    # Mark all packets with seq_id < ack_id as acked, seq ids are
+                    # multiples of MESSAGE_SIZE so the cutoff is a ceiling division
+                    cutoff = -(-ack_id // MESSAGE_SIZE)
+
+                    # Fast retransmit, repeated ACKs for the window start mean that
+                    # packet was lost while later ones got through. Once per
+                    # recovery episode, partial ACKs take care of the rest
+                    if cutoff == window_start:
+                        dup_count += 1
+                        if (dup_count == DUP_ACK_THRESHOLD and window_start < next_to_send
+                                and window_start >= recover):
+                            if send_batch(sock, batch, [window_start]):
+                                total_packets_sent += 1
+                                send_count[window_start] += 1
+                                last_send_ns[window_start] = now()
+                            recover = next_to_send
+                        continue
+                    if cutoff < window_start:
+                        continue  # reordered, older than what is already acked
+                    dup_count = 0
+
+                    # Stamp the newly acked packets in one slice assignment,
+                    # delays are worked out once the transfer is done
+                    ack_ns = now()
+                    acked_ns[window_start:cutoff] = array('q', [ack_ns]) * (cutoff - window_start)
+
+                    # RTT sample from the newest acked packet, unless any packet
+                    # this ACK covers was retransmitted (Karn's rule), a jump
+                    # over a refilled hole was triggered by the retransmit
+                    if max(send_count[window_start:cutoff]) == 1:
+                        srtt, rttvar = update_rtt(srtt, rttvar, ack_ns - first_send_ns[cutoff - 1])
+                        rto_ns = int(max(MIN_RTO_NS, min(TIMEOUT_NS, srtt + 4 * rttvar + MAX_ACK_DELAY_NS)))
+
+                    # Slide window forward, ACKs are cumulative so everything
+                    # below the cutoff is acked
+                    window_start = cutoff
+                    next_to_send = max(next_to_send, window_start)
+                    last_ack_ns = moved_ns = ack_ns
+                    retry_count = 0
+
+                    # A partial ACK after a fast retransmit or timeout means the
+                    # new window start was lost too, and likely other packets
+                    # from before the loss. Resend it and every unacked packet
+                    # sent more than an SRTT ago instead of letting each hole
+                    # wait for the timer
+                    if cutoff < recover:
+                        stale_ns = ack_ns - (int(srtt) if srtt is not None else rto_ns)
+                        to_send = [i for i in range(cutoff, next_to_send)
+                                   if i == cutoff or last_send_ns[i] < stale_ns]
+                        sent = send_batch(sock, batch, to_send)
+                        total_packets_sent += sent
+                        for i in to_send[:sent]:
+                            send_count[i] += 1
+                            last_send_ns[i] = ack_ns
+
+        # Timeout, the window has not moved for a whole RTO
+        timer_ns = min(MAX_BACKOFF_NS, rto_ns << retry_count, moved_ns + MAX_STALL_NS - last_ack_ns)
+        if window_start < total_packets and now() - last_ack_ns >= timer_ns:
+            # Backed off timers grow to MAX_BACKOFF_NS, so the stall time
+            # rather than the count bounds how long a dead path is retried
+            retry_count += 1
+            if retry_count >= MAX_RETRIES or now() - moved_ns >= MAX_STALL_NS:
+                sock.close()
+                return None, None, None
+
+            # Timeout
+            log_tick += 1
+            if DEBUG and log_tick == LOG_EVERY:
+                log("Timeout %d, resending from seq %d", retry_count, seq_ids[window_start])
+                log_tick = 0
+
+            # Retransmit unacked packets that have retries left. The window
+            # start always goes out, nothing can move until it is acked, and
+            # MAX_STALL_NS is what ends a transfer that is not getting through
+            to_send = [i for i in range(window_start, next_to_send)
+                       if i == window_start or send_count[i] < PER_PKT_RETRY_LIMIT]
+            sent = send_batch(sock, batch, to_send)
+            total_packets_sent += sent
+            last_ack_ns = now()
+            for i in to_send[:sent]:
+                send_count[i] += 1
+                last_send_ns[i] = last_ack_ns
+            recover = next_to_send
 
-    
     # Send empty packet to signal end
-    final_seq_id = packets[-1]['seq_id'] + len(packets[-1]['data'])
+    final_seq_id = total_bytes
     final_packet = create_packet(final_seq_id, b'')
-    sock.sendto(final_packet, (RECEIVER_IP, RECEIVER_PORT))
+    sock.send(final_packet)
     
-    try:
-        ack_packet, _ = sock.recvfrom(PACKET_SIZE)
-        fin_packet, _ = sock.recvfrom(PACKET_SIZE)
-    except socket.timeout:
-        pass
+    # Wait for the ack and fin, giving up after TIMEOUT without either
+    for _ in range(2):
+        if not ready(TIMEOUT * 1000):
+            break
+        try:
+            sock.recv(PACKET_SIZE)
+        except ConnectionRefusedError:
+            break
     
     # Send FINACK
     finack_packet = create_packet(0, b'==FINACK==')
-    sock.sendto(finack_packet, (RECEIVER_IP, RECEIVER_PORT))
+    sock.send(finack_packet)
     
     # Calc metrics
     end_time = time.time()
@@ -180,12 +382,21 @@ def send_file_fixed_window():
     
     # Calc results
     throughput = total_bytes / total_time
-    avg_delay = sum(packet_delays) / len(packet_delays) if packet_delays else 0
+    packet_delays_ns = [a - f for a, f in zip(acked_ns, first_send_ns)]
+    avg_delay = math.fsum(packet_delays_ns) / len(packet_delays_ns) * 1e-9 if packet_delays_ns else 0
+    if DEBUG and packet_delays_ns:
+        packet_delays_ns.sort()
+        n = len(packet_delays_ns)
+        log("Delay p50 %.6f s, p99 %.6f s", packet_delays_ns[n // 2] * 1e-9,
+            packet_delays_ns[min(n - 1, n * 99 // 100)] * 1e-9)
     performance_metric = (0.3 * throughput / 1000) + (0.7 / avg_delay) if avg_delay > 0 else 0
     
     return throughput, avg_delay, performance_metric
 
 def main():
+    if DEBUG:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='%(message)s')
+
     throughput, avg_delay, metric = send_file_fixed_window()
     
     if throughput is not None:
@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 
+import ctypes
+import errno
+import logging
+import os
+import select
+import sys
 import socket
 import time
-import threading
+from array import array
+from collections import deque
+from itertools import repeat
 
 # Constants
 PACKET_SIZE = 1024
@@ -10,10 +18,28 @@ SEQ_ID_SIZE = 4
 MESSAGE_SIZE = PACKET_SIZE - SEQ_ID_SIZE
 RECEIVER_IP = '127.0.0.1'
 RECEIVER_PORT = 5001
+RECEIVER_ADDR = (RECEIVER_IP, RECEIVER_PORT)
 TIMEOUT = 0.5
-INITIAL_CWND = 1
-INITIAL_SSTHRESH = 64
+# Start windows in packets, overridable for tuning runs
+INITIAL_CWND = int(os.environ.get('RENO_INITIAL_CWND', 10))
+INITIAL_SSTHRESH = int(os.environ.get('RENO_INITIAL_SSTHRESH', 64))
+LOSS_CWND = 1  # window after a retransmission timeout
+# Congestion control states
+SLOW_START = 0
+CONGESTION_AVOIDANCE = 1
+FAST_RECOVERY = 2
+STATE_NAMES = ("SLOW_START", "CONGESTION_AVOIDANCE", "FAST_RECOVERY")
+MAX_BURST = 64  # most packets handed to one sendmmsg call
+RECV_BATCH = 64  # most ACKs taken from one recvmmsg call
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+SO_SNDBUFFORCE = 32  # linux/socket.h, not exported by the socket module
+SO_RCVBUFFORCE = 33
+FIN_TIMEOUT = 0.2  # wait for the receiver's FIN before resending ours
+FIN_RETRIES = 5
 FILE_PATH = 'file.mp3'
+DEBUG = False  # congestion state and summary logging to stderr
+
+log = logging.getLogger(__name__).debug
 
 def create_packet(seq_id, data):
     seq_bytes = int.to_bytes(seq_id, SEQ_ID_SIZE, signed=True, byteorder='big')
@@ -25,6 +51,52 @@ def parse_ack(ack_packet):
         return ack_id
     return -1
 
+# sendmmsg(2)/recvmmsg(2) structures, so a burst of packets goes out and a
+# burst of ACKs comes in with one syscall each
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+try:
+    libc = ctypes.CDLL("libc.so.6", use_errno=True)
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+except (OSError, AttributeError):
+    # Not Linux/glibc, send_batch and recv_batch fall back to one
+    # send/recv per packet
+    libc = None
+
+def set_socket_buffers(sock, size):
+    # Enlarge the kernel buffers so a cwnd burst or ACK flood is not dropped
+    # locally. The FORCE variants ignore wmem_max/rmem_max but need
+    # CAP_NET_ADMIN, without it the plain options are capped by those sysctls
+    linux = sys.platform.startswith('linux')
+    for force, option in ((SO_SNDBUFFORCE, socket.SO_SNDBUF), (SO_RCVBUFFORCE, socket.SO_RCVBUF)):
+        if linux:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, force, size)
+                continue
+            except OSError:
+                pass
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+    if DEBUG:
+        log("Socket buffers: send %d, receive %d",
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
 class TCPRenoSender:
     """TCP Reno sender implementing basic congestion control for simulation."""
 
@@ -33,24 +105,66 @@ class TCPRenoSender:
         self.sock = sock
         self.total_bytes = len(file_data)
         
+        # Build every packet (seq id header + payload) once, indexed by
+        # seq_id // MESSAGE_SIZE, so sends and retransmits never assemble one.
+        # Payloads are memoryview slices, so the header concatenation is the
+        # only copy of each chunk
+        mv = memoryview(file_data)
+        self.wire = tuple(create_packet(i, mv[i:i + MESSAGE_SIZE])
+                          for i in range(0, self.total_bytes, MESSAGE_SIZE))
+        mv.release()
+        
+        # sendmmsg slots, each send only patches in the packet address and
+        # length, no msg_name as the socket is connected
+        self.wire_addrs = array('Q', (ctypes.cast(p, ctypes.c_void_p).value for p in self.wire))
+        self.iovs = (iovec * MAX_BURST)()
+        self.msgs = (mmsghdr * MAX_BURST)()
+        for k in range(MAX_BURST):
+            hdr = self.msgs[k].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self.iovs[k])
+            hdr.msg_iovlen = 1
+        
+        # recvmmsg slots, slot k receives into row k of recv_buf
+        self.use_recvmmsg = libc is not None
+        self.recv_buf = bytearray(RECV_BATCH * PACKET_SIZE)
+        self.recv_view = memoryview(self.recv_buf)
+        self.recv_iovs = (iovec * RECV_BATCH)()
+        self.recv_msgs = (mmsghdr * RECV_BATCH)()
+        recv_base = ctypes.addressof(ctypes.c_char.from_buffer(self.recv_buf))
+        for k in range(RECV_BATCH):
+            self.recv_iovs[k].iov_base = recv_base + k * PACKET_SIZE
+            self.recv_iovs[k].iov_len = PACKET_SIZE
+            hdr = self.recv_msgs[k].msg_hdr
+            hdr.msg_iov = ctypes.pointer(self.recv_iovs[k])
+            hdr.msg_iovlen = 1
+        
         self.window_base = 0
         self.next_seq = 0
+        self.base_idx = 0  # first packet not yet acked
+        self.next_idx = 0  # next packet to send
         
         self.cwnd = INITIAL_CWND
         self.ssthresh = INITIAL_SSTHRESH
-        self.state = "SLOW_START"
+        self.state = SLOW_START
         
         self.last_ack = 0
         self.dup_ack_count = 0
+        self.recover = 0  # next_seq when fast recovery was entered
         
-        self.packets = {}
-        self.acked = set()
+        # Per packet state, one flat array per field indexed like self.wire
+        n = len(self.wire)
+        self.acked_bm = bytearray(n)
+        self.send_time = array('d', [0.0]) * n
+        self.first_send_time = array('d', [0.0]) * n
         
-        self.packet_delays = []
-        self.start_time = None
+        # (deadline, idx) per send in send order, which is also deadline
+        # order, so timeouts only ever look at the head
+        self.pending = deque()
         
-        self.lock = threading.Lock()
-        self.running = True
+        # Each packet is acked once, so n slots always suffice
+        self.packet_delays = array('d', [0.0]) * n
+        self.delay_count = 0
+        self.start_time = None
         
         # Stats for printing
         self.packets_sent_count = 0
@@ -63,167 +177,277 @@ class TCPRenoSender:
     
     def on_new_ack(self):
         old_state = self.state
-        old_cwnd = self.cwnd
         
-        if self.state == "SLOW_START":
+        if self.state == SLOW_START:
             self.cwnd += 1
             if self.cwnd >= self.ssthresh:
-                self.state = "CONGESTION_AVOIDANCE"
-        elif self.state == "CONGESTION_AVOIDANCE":
+                self.state = CONGESTION_AVOIDANCE
+        elif self.state == CONGESTION_AVOIDANCE:
             self.cwnd += 1.0 / self.cwnd
-        elif self.state == "FAST_RECOVERY":
+        elif self.state == FAST_RECOVERY:
             self.cwnd = self.ssthresh
-            self.state = "CONGESTION_AVOIDANCE"
+            self.state = CONGESTION_AVOIDANCE
+        
+        if DEBUG and self.state != old_state:
+            log("%s -> %s, cwnd %.2f", STATE_NAMES[old_state], STATE_NAMES[self.state], self.cwnd)
     
     def on_timeout(self):
         self.timeouts += 1
         self.ssthresh = max(self.cwnd / 2, 2)
-        self.cwnd = INITIAL_CWND
-        self.state = "SLOW_START"
+        self.cwnd = LOSS_CWND
+        self.state = SLOW_START
         self.dup_ack_count = 0
+        if DEBUG:
+            log("Timeout, ssthresh %.2f", self.ssthresh)
     
     def on_triple_dup_ack(self, ack_id):
         self.fast_retransmits += 1
-        
-        if ack_id in self.packets:
-            chunk, _, first_send_time = self.packets[ack_id]
-            packet = create_packet(ack_id, chunk)
-            self.sock.sendto(packet, (RECEIVER_IP, RECEIVER_PORT))
-            self.retransmissions += 1
-            current_time = time.time()
-            self.packets[ack_id] = (chunk, current_time, first_send_time)
+        self.retransmit(ack_id)
         
         old_cwnd = self.cwnd
         self.ssthresh = max(self.cwnd / 2, 2)
         self.cwnd = self.ssthresh + 3
-        self.state = "FAST_RECOVERY"
+        self.state = FAST_RECOVERY
+        self.recover = self.next_seq
+        if DEBUG:
+            log("Triple dup ACK %d, cwnd %.2f -> %.2f", ack_id, old_cwnd, self.cwnd)
     
-    def send_packets(self):        
-        while self.next_seq < self.total_bytes:
-            with self.lock:
-                bytes_in_flight = self.next_seq - self.window_base
-                window_size_bytes = self.get_window_size_bytes()
-                
-                if bytes_in_flight >= window_size_bytes:
-                    time.sleep(0.001)
+    def on_partial_ack(self, ack_id, newly_acked):
+        # NewReno: the ACK stops short of recover, so the packet at ack_id
+        # was lost too. Resend it and stay in fast recovery, deflating by
+        # what was acked and inflating by one for the resend
+        self.retransmit(ack_id)
+        self.cwnd = max(self.cwnd - newly_acked, 1) + 1
+        if DEBUG:
+            log("Partial ACK %d, recover %d, cwnd %.2f", ack_id, self.recover, self.cwnd)
+    
+    def retransmit(self, ack_id):
+        idx = ack_id // MESSAGE_SIZE
+        if idx < self.next_idx and not self.acked_bm[idx]:
+            self.send_batch([idx])
+            self.retransmissions += 1
+            current_time = time.monotonic()
+            self.send_time[idx] = current_time
+            self.pending.append((current_time + TIMEOUT, idx))
+    
+    def send_batch(self, indices):
+        # Send the given packets MAX_BURST at a time with sendmmsg
+        sent = 0
+        if libc is not None:
+            fd = self.sock.fileno()
+            for start in range(0, len(indices), MAX_BURST):
+                burst = indices[start:start + MAX_BURST]
+                for k, i in enumerate(burst):
+                    self.iovs[k].iov_base = self.wire_addrs[i]
+                    self.iovs[k].iov_len = len(self.wire[i])
+                done = 0
+                while done < len(burst):
+                    n = libc.sendmmsg(fd, ctypes.byref(self.msgs, done * ctypes.sizeof(mmsghdr)), len(burst) - done, 0)
+                    if n >= 0:
+                        done += n
+                    elif ctypes.get_errno() != errno.EINTR:
+                        break
+                sent += done
+                if done < len(burst):
+                    break  # finish with send below
+        for i in indices[sent:]:
+            try:
+                self.sock.send(self.wire[i])
+            except ConnectionRefusedError:
+                pass  # ICMP unreachable from an earlier packet, a timeout resends it
+    
+    def send_packets(self):
+        # Send new packets until the window is full
+        window_end = min(self.window_base + self.get_window_size_bytes(), self.total_bytes)
+        if self.next_seq >= window_end:
+            return
+        
+        # Every packet starting below window_end, the burst is a contiguous
+        # index range so no per-packet bookkeeping is needed to find it
+        start = self.next_idx
+        end = -(-window_end // MESSAGE_SIZE)
+        burst = range(start, end)
+        self.next_idx = end
+        self.next_seq = min(end * MESSAGE_SIZE, self.total_bytes)
+        
+        # One clock read for the whole burst, monotonic so delays can never
+        # go negative on a wall clock step
+        current_time = time.monotonic()
+        self.send_batch(burst)
+        
+        self.packets_sent_count += len(burst)
+        stamps = array('d', [current_time]) * len(burst)
+        self.send_time[start:end] = stamps
+        self.first_send_time[start:end] = stamps
+        self.pending.extend(zip(repeat(current_time + TIMEOUT), burst))
+    
+    def recv_batch(self):
+        # Up to RECV_BATCH queued ACK ids from one recvmmsg call, [] once drained
+        if self.use_recvmmsg:
+            n = libc.recvmmsg(self.sock.fileno(), self.recv_msgs, RECV_BATCH, socket.MSG_DONTWAIT, None)
+            if n >= 0:
+                view = self.recv_view
+                return [parse_ack(view[k * PACKET_SIZE:k * PACKET_SIZE + self.recv_msgs[k].msg_len])
+                        for k in range(n)]
+            if ctypes.get_errno() != errno.ENOSYS:
+                return []  # EAGAIN, nothing queued
+            self.use_recvmmsg = False
+        try:
+            ack_packet = self.sock.recv(PACKET_SIZE, socket.MSG_DONTWAIT)
+        except (BlockingIOError, ConnectionRefusedError):
+            return []
+        return [parse_ack(ack_packet)]
+    
+    def receive_acks(self):
+        # Drain every ACK already queued on the socket without blocking.
+        # Duplicates in fast recovery only inflate cwnd, so they are counted
+        # and applied in one step before the next new ACK or at the end
+        inflate = 0
+        while True:
+            ack_ids = self.recv_batch()
+            if not ack_ids:
+                break
+            for ack_id in ack_ids:
+                if ack_id == self.last_ack and self.state == FAST_RECOVERY:
+                    inflate += 1
                     continue
+                if inflate:
+                    self.cwnd += inflate
+                    self.dup_ack_count += inflate
+                    inflate = 0
+                self.on_ack(ack_id)
+        if inflate:
+            self.cwnd += inflate
+            self.dup_ack_count += inflate
+    
+    def on_ack(self, ack_id):
+        if ack_id == self.last_ack:
+            self.dup_ack_count += 1
+            
+            if self.state == FAST_RECOVERY:
+                self.cwnd += 1
+            elif self.dup_ack_count == 3:
+                self.on_triple_dup_ack(ack_id)
+        else:
+            if ack_id > self.last_ack:
+                # Packets before the first one ack_id does not
+                # cover, i.e. ceil(ack_id / MESSAGE_SIZE)
+                new_idx = min(-(-ack_id // MESSAGE_SIZE), self.next_idx)
+                current_time = time.monotonic()
+                for i in range(self.base_idx, new_idx):
+                    if not self.acked_bm[i]:
+                        self.acked_bm[i] = 1
+                        self.packet_delays[self.delay_count] = current_time - self.first_send_time[i]
+                        self.delay_count += 1
+                newly_acked = new_idx - self.base_idx
+                self.base_idx = max(self.base_idx, new_idx)
                 
-                offset = self.next_seq
-                chunk = self.file_data[offset:offset + MESSAGE_SIZE]
-                if not chunk:
-                    break
-                
-                packet = create_packet(self.next_seq, chunk)
-                self.sock.sendto(packet, (RECEIVER_IP, RECEIVER_PORT))
-                
-                self.packets_sent_count += 1
-                current_time = time.time()
-                self.packets[self.next_seq] = (chunk, current_time, current_time)
-                
+                if self.state == FAST_RECOVERY and ack_id < self.recover:
+                    self.on_partial_ack(ack_id, newly_acked)
+                else:
+                    self.on_new_ack()
+                self.window_base = ack_id
                 
-                self.next_seq += len(chunk)
-        
+                self.last_ack = ack_id
+                self.dup_ack_count = 0
     
-    def receive_acks(self):
-        self.sock.settimeout(0.05)
+    def check_timeouts(self):
+        current_time = time.monotonic()
+        pending = self.pending
+        expired = []
+        while pending and pending[0][0] < current_time:
+            _, i = pending.popleft()
+            # Entries for acked packets, or for sends that were since
+            # superseded by a retransmit, are dropped
+            if not self.acked_bm[i] and (current_time - self.send_time[i]) > TIMEOUT:
+                self.send_time[i] = current_time
+                expired.append(i)
+        if not expired:
+            return
         
-        while self.running:
-            try:
-                ack_packet, _ = self.sock.recvfrom(PACKET_SIZE)
-                ack_id = parse_ack(ack_packet)
-                
-                with self.lock:
-                    if ack_id == self.last_ack:
-                        self.dup_ack_count += 1
-                        
-                        if self.dup_ack_count == 3:
-                            self.on_triple_dup_ack(ack_id)
-                        elif self.state == "FAST_RECOVERY":
-                            self.cwnd += 1
-                    else:
-                        if ack_id > self.last_ack:
-                            acked_packets = []
-                            for seq_id in list(self.packets.keys()):
-                                if seq_id < ack_id:
-                                    if seq_id not in self.acked:
-                                        chunk, _, first_send_time = self.packets[seq_id]
-                                        delay = time.time() - first_send_time
-                                        self.packet_delays.append(delay)
-                                        self.acked.add(seq_id)
-                                        acked_packets.append(seq_id)
-                            
-                            self.on_new_ack()
-                            self.window_base = ack_id
-                            
-                            for seq_id in acked_packets:
-                                if seq_id in self.packets:
-                                    del self.packets[seq_id]
-                            
-                            self.last_ack = ack_id
-                            self.dup_ack_count = 0
-                    
-            except socket.timeout:
-                with self.lock:
-                    current_time = time.time()
-                    timeout_occurred = False
-                    
-                    for seq_id, (chunk, send_time, first_send_time) in list(self.packets.items()):
-                        if seq_id not in self.acked and (current_time - send_time) > TIMEOUT:
-                            packet = create_packet(seq_id, chunk)
-                            self.sock.sendto(packet, (RECEIVER_IP, RECEIVER_PORT))
-                            self.retransmissions += 1
-                            self.packets[seq_id] = (chunk, current_time, first_send_time)
-                            
-                            if not timeout_occurred:
-                                self.on_timeout()
-                                timeout_occurred = True
-            except Exception as e:
-                pass
+        self.send_batch(expired)
+        self.retransmissions += len(expired)
+        deadline = current_time + TIMEOUT
+        for i in expired:
+            pending.append((deadline, i))
+        self.on_timeout()
     
     def send_file(self):
         self.start_time = time.time()
         
-        receiver_thread = threading.Thread(target=self.receive_acks)
-        receiver_thread.daemon = True
-        receiver_thread.start()
-        
-        self.send_packets()
+        # One thread does everything: fill the window, sleep until ACKs
+        # arrive or the oldest outstanding send expires, then drain and
+        # retransmit. Edge-triggered epoll only reports new datagrams,
+        # which is fine since receive_acks always drains the socket
+        if hasattr(select, 'epoll'):
+            ep = select.epoll()
+            ep.register(self.sock.fileno(), select.EPOLLIN | select.EPOLLET)
+            wait = ep.poll
+        else:
+            ep = None
+            wait = lambda timeout: select.select([self.sock], [], [], timeout)[0]
         
         max_wait = 30
-        wait_start = time.time()
+        wait_start = None
+        pending = self.pending
         while self.window_base < self.total_bytes:
-            if time.time() - wait_start > max_wait:
-                break
-            time.sleep(0.1)
+            self.send_packets()
+            
+            if pending:
+                timeout = max(pending[0][0] - time.monotonic(), 0)
+            else:
+                timeout = TIMEOUT
+            if wait(timeout):
+                self.receive_acks()
+            
+            self.check_timeouts()
+            
+            current_time = time.monotonic()
+            
+            # Give up on the tail if it stays unacked for too long
+            if self.next_seq >= self.total_bytes:
+                if wait_start is None:
+                    wait_start = current_time
+                elif current_time - wait_start > max_wait:
+                    break
         
-        final_packet = create_packet(self.window_base, b'')
-        for _ in range(5):
-            self.sock.sendto(final_packet, (RECEIVER_IP, RECEIVER_PORT))
-            time.sleep(0.05)
+        if ep is not None:
+            ep.close()
         
-        self.sock.settimeout(1.0)
-        try:
-            ack_packet, _ = self.sock.recvfrom(PACKET_SIZE)
-            fin_packet, _ = self.sock.recvfrom(PACKET_SIZE)
-        except socket.timeout:
-            pass
+        # Send the empty packet once and resend it only if the receiver's
+        # FIN (id + 3) does not come back in time, skipping any late ACKs
+        final_packet = create_packet(self.window_base, b'')
+        fin_id = self.window_base + 3
+        self.sock.settimeout(FIN_TIMEOUT)
+        for _ in range(FIN_RETRIES):
+            self.sock.send(final_packet)
+            try:
+                while parse_ack(self.sock.recv(PACKET_SIZE)) != fin_id:
+                    pass
+                break
+            except (socket.timeout, ConnectionRefusedError):
+                pass
         
         finack_packet = create_packet(0, b'==FINACK==')
-        self.sock.sendto(finack_packet, (RECEIVER_IP, RECEIVER_PORT))
-        
-        self.running = False
+        self.sock.send(finack_packet)
         
         end_time = time.time()
         total_time = end_time - self.start_time
         
+        log("Sent %d packets, %d retransmissions, %d timeouts, %d fast retransmits",
+            self.packets_sent_count, self.retransmissions, self.timeouts, self.fast_retransmits)
+        
         throughput = self.total_bytes / total_time if total_time > 0 else 0
-        avg_delay = sum(self.packet_delays) / len(self.packet_delays) if self.packet_delays else 0
+        count = self.delay_count
+        avg_delay = sum(self.packet_delays[:count]) / count if count else 0
         performance_metric = (0.3 * throughput / 1000) + (0.7 / avg_delay) if avg_delay > 0 else 0
         
         return throughput, avg_delay, performance_metric
 
 def send_file_tcp_reno():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    set_socket_buffers(sock, SOCKET_BUFFER_SIZE)
+    sock.connect(RECEIVER_ADDR)
     
     with open(FILE_PATH, 'rb') as f:
         file_data = f.read()
@@ -236,6 +460,9 @@ def send_file_tcp_reno():
     return throughput, avg_delay, performance_metric
 
 def main():
+    if DEBUG:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG, format='%(message)s')
+    
     throughput, avg_delay, metric = send_file_tcp_reno()
     
     if throughput is not None and throughput > 0:
@@ -1,4 +1,8 @@
 #!/usr/bin/env python3
+import asyncio
+import math
+import mmap
+import os
 import socket
 import time
 
@@ -8,9 +12,12 @@ SEQ_ID_SIZE = 4
 MESSAGE_SIZE = PACKET_SIZE - SEQ_ID_SIZE
 RECEIVER_IP = '127.0.0.1'
 RECEIVER_PORT = 5001
-TIMEOUT = 1.0
+RECEIVER_ADDR = (RECEIVER_IP, RECEIVER_PORT)
+TIMEOUT = 1.0  # also the ceiling for the adaptive RTO
+MIN_RTO = 0.001
 MAX_RETRIES = 50
 FILE_PATH = 'file.mp3'
+SOCKET_BUFFER_SIZE = 8 * 1024 * 1024  # kernel may cap at wmem_max/rmem_max
 
 def create_packet(seq_id, data):
     """Create a packet with sequence number and data."""
@@ -24,21 +31,64 @@ def parse_ack(ack_packet):
         return ack_id
     return -1
 
-def send_file_stop_and_wait():
+def update_rtt(srtt, rttvar, sample):
+    """Update smoothed RTT and RTT variance with a new sample (RFC 6298)."""
+    if srtt is None:
+        return sample, sample / 2
+    rttvar = 0.75 * rttvar + 0.25 * abs(srtt - sample)
+    srtt = 0.875 * srtt + 0.125 * sample
+    return srtt, rttvar
+
+class AckProtocol(asyncio.DatagramProtocol):
+    """Wake the sender as soon as the ACK it is waiting for arrives."""
+
+    def __init__(self):
+        self.expected = None
+        self.waiter = None
+
+    def datagram_received(self, data, addr):
+        waiter = self.waiter
+        if waiter is not None and not waiter.done() and parse_ack(data) == self.expected:
+            waiter.set_result(None)
+
+    def error_received(self, exc):
+        """ICMP errors (e.g. receiver not up yet) are handled like a lost packet."""
+
+    def wait_for_ack(self, expected, timeout):
+        """Return an awaitable that completes when ACK `expected` arrives."""
+        self.expected = expected
+        self.waiter = asyncio.get_running_loop().create_future()
+        return asyncio.wait_for(self.waiter, timeout)
+
+async def send_file_stop_and_wait():
     """
     Send file using Stop-and-Wait protocol.
     Returns: (throughput, avg_delay, performance_metric)
     """
     # Create UDP socket
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(TIMEOUT)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+    # Fix the peer once so sends skip address conversion and only the
+    # receiver's datagrams are delivered
+    sock.connect(RECEIVER_ADDR)
 
-    # Read file data
+    # Map file data, chunks are copied out of the page cache as they are sent
     try:
         with open(FILE_PATH, 'rb') as f:
-            file_data = f.read()
+            if os.fstat(f.fileno()).st_size:
+                file_data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                file_data = b''  # mmap refuses empty files
     except Exception:
+        sock.close()
         return None, None, None
+
+    # ACKs are delivered to the protocol by the event loop instead of a
+    # blocking recvfrom, so the next send goes out right after the ACK
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_datagram_endpoint(AckProtocol, sock=sock)
     
     total_bytes = len(file_data)
     total_packets = (total_bytes + MESSAGE_SIZE - 1) // MESSAGE_SIZE
@@ -51,6 +101,8 @@ def send_file_stop_and_wait():
     packet_delays = []
     offset = 0
     packets_sent = 0
+    srtt = rttvar = None
+    rto = TIMEOUT  # until the first RTT sample
     
     # Send all packets
     while offset < total_bytes:
@@ -62,69 +114,80 @@ def send_file_stop_and_wait():
         first_send_time = time.time()
         ack_received = False
         retries = 0
+        sends = 0
         
+        # ACK id that confirms this chunk
+        expected_ack = seq_id + len(chunk)
+
+        # Backoff spreads the retries out, so the packet gets the same total
+        # budget as MAX_RETRIES plain timeouts
+        give_up = first_send_time + MAX_RETRIES * TIMEOUT
+
         while not ack_received and retries < MAX_RETRIES:
+            remaining = give_up - time.time()
+            if remaining <= 0:
+                break
+
             # Send packet
+            transport.sendto(packet)
+            packets_sent += 1
+            sends += 1
+
             try:
-                sock.sendto(packet, (RECEIVER_IP, RECEIVER_PORT))
-                packets_sent += 1
-            except Exception:
+                # Wait for ACK, backing off exponentially on repeated timeouts
+                await protocol.wait_for_ack(expected_ack, min(remaining, rto * (1 << min(retries, 6))))
+            except asyncio.TimeoutError:
                 retries += 1
                 continue
-            
-            try:
-                # Wait for ACK
-                ack_packet, _ = sock.recvfrom(PACKET_SIZE)
-                ack_id = parse_ack(ack_packet)
-                
-                # Check if ACK matches expected sequence
-                expected_ack = seq_id + len(chunk)
-                if ack_id == expected_ack:
-                    # Calculate delay from first send to ACK receipt
-                    packet_delay = time.time() - first_send_time
-                    packet_delays.append(packet_delay)
-                    
-                    # Move to next packet
-                    seq_id = expected_ack
-                    offset += len(chunk)
-                    ack_received = True
-            except socket.timeout:
-                retries += 1
-                
+
+            # Calculate delay from first send to ACK receipt
+            packet_delay = time.time() - first_send_time
+            packet_delays.append(packet_delay)
+
+            # Only unambiguous samples feed the RTO (Karn's rule)
+            if sends == 1:
+                srtt, rttvar = update_rtt(srtt, rttvar, packet_delay)
+                rto = max(MIN_RTO, min(TIMEOUT, srtt + 4 * rttvar))
+
+            # Move to next packet
+            seq_id = expected_ack
+            offset += len(chunk)
+            ack_received = True
+
         if not ack_received:
-            sock.close()
+            transport.close()
             return None, None, None
     
     # Send empty packet to signal end
     final_packet = create_packet(seq_id, b'')
-    sock.sendto(final_packet, (RECEIVER_IP, RECEIVER_PORT))
+    transport.sendto(final_packet)
 
+    # The receiver answers with an ACK and then a FIN (id + 3)
     try:
-        ack_packet, _ = sock.recvfrom(PACKET_SIZE)
-        fin_packet, _ = sock.recvfrom(PACKET_SIZE)
-    except socket.timeout:
+        await protocol.wait_for_ack(seq_id + 3, TIMEOUT)
+    except asyncio.TimeoutError:
         pass
 
     # Send FINACK
     finack_packet = create_packet(0, b'==FINACK==')
-    sock.sendto(finack_packet, (RECEIVER_IP, RECEIVER_PORT))
+    transport.sendto(finack_packet)
     
     # Calculate metrics
     end_time = time.time()
     total_time = end_time - start_time
     
-    sock.close()
+    transport.close()
     
     # Calculate results
     throughput = total_bytes / total_time
-    avg_delay = sum(packet_delays) / len(packet_delays) if packet_delays else 0
+    avg_delay = math.fsum(packet_delays) / len(packet_delays) if packet_delays else 0
     performance_metric = (0.3 * throughput / 1000) + (0.7 / avg_delay) if avg_delay > 0 else 0
     
     return throughput, avg_delay, performance_metric
 
 def main():
     """Run once and output metrics."""
-    throughput, avg_delay, metric = send_file_stop_and_wait()
+    throughput, avg_delay, metric = asyncio.run(send_file_stop_and_wait())
     
     if throughput is not None:
         print(f"{throughput:.7f}")